@@ -0,0 +1,230 @@
+import asyncio
+import math
+import time
+import logging
+from collections import Counter, deque
+from typing import Dict, List, Optional, Tuple
+
+from states import BusState, Location
+from algo.bus_logic import get_trip_duration
+
+# Grid cell size in degrees (~500m north-south).
+CELL_SIZE = 0.005
+# Ride requests older than this drop out of the demand histogram.
+DEMAND_WINDOW = 15 * 60
+# Number of hot cells kept precomputed.
+HOT_CELLS = 8
+# Cells need at least this many recent requests to be considered hot.
+MIN_CELL_REQUESTS = 2
+# Number of ranked buses kept per hot cell and re-checked on a request.
+CANDIDATES = 3
+# A ranked bus only invalidates its cell once it moved further than this (meters).
+DRIFT_METERS = 250.0
+# Slow city speed (m/s) used to estimate how much a move can shorten an
+# unranked bus's trip; lower means more conservative invalidation.
+MIN_SPEED_MPS = 5.0
+
+Cell = Tuple[int, int]
+
+
+def cell_of(loc: Location) -> Cell:
+    return (math.floor(loc.latitude / CELL_SIZE), math.floor(loc.longitude / CELL_SIZE))
+
+
+def cell_center(cell: Cell) -> Location:
+    return Location(latitude=(cell[0] + 0.5) * CELL_SIZE, longitude=(cell[1] + 0.5) * CELL_SIZE)
+
+
+def distance_meters(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """
+    Equirectangular approximation, good enough at city scale.
+    """
+    lat = math.radians((a[0] + b[0]) / 2)
+    dx = math.radians(b[1] - a[1]) * math.cos(lat)
+    dy = math.radians(b[0] - a[0])
+    return 6371000 * math.hypot(dx, dy)
+
+
+class DemandGrid:
+    """
+    Rolling histogram of pickup requests over a fixed lat/lon grid.
+    """
+    def __init__(self, window: float = DEMAND_WINDOW):
+        self.window = window
+        self.events: deque = deque()
+        self.counts: Counter = Counter()
+
+    def _expire(self, now: float):
+        while self.events and self.events[0][0] < now - self.window:
+            _, cell = self.events.popleft()
+            self.counts[cell] -= 1
+            if self.counts[cell] <= 0:
+                del self.counts[cell]
+
+    def record(self, loc: Location, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        cell = cell_of(loc)
+        self.events.append((now, cell))
+        self.counts[cell] += 1
+
+    def hot_cells(self, k: int = HOT_CELLS, now: Optional[float] = None) -> List[Cell]:
+        self._expire(time.monotonic() if now is None else now)
+        return [cell for cell, count in self.counts.most_common(k) if count >= MIN_CELL_REQUESTS]
+
+
+class BusSnapshot:
+    """
+    What a bus looked like when a cell was ranked.
+    """
+    def __init__(self, bus: BusState):
+        self.position = (bus.location.latitude, bus.location.longitude)
+        self.route = [tuple(stop.to_list()) for stop in bus.route]
+        self.cost = float('inf')
+
+
+def dispatchable(bus: BusState) -> bool:
+    # Same condition get_bus uses before calling find_optimal_bus
+    return bool(bus.location and bus.route)
+
+
+class CellRanking:
+    """
+    Buses ranked by total trip duration with a pickup at the cell center (the
+    objective find_optimal_bus uses), plus a snapshot of every bus evaluated.
+    """
+    def __init__(self, candidates: List[BusState], snapshots: Dict[int, BusSnapshot]):
+        self.candidates = candidates
+        self.snapshots = snapshots
+        # An unranked bus has to get below this to matter.
+        self.worst_cost = snapshots[candidates[-1].bus_id].cost if len(candidates) == CANDIDATES else float('inf')
+
+    def is_stale(self, bus: BusState, removed: bool = False) -> bool:
+        """
+        Whether a change to `bus` can alter this cell's top candidates.
+        """
+        ranked = bus in self.candidates
+        if removed:
+            return ranked
+        snap = self.snapshots.get(bus.bus_id)
+        if snap is None:
+            # A bus that was not evaluated yet could beat the ranked ones.
+            return dispatchable(bus)
+        if ranked:
+            return (
+                not dispatchable(bus)
+                or [tuple(stop.to_list()) for stop in bus.route] != snap.route
+                or distance_meters(snap.position, (bus.location.latitude, bus.location.longitude)) > DRIFT_METERS
+            )
+        if not dispatchable(bus):
+            return False
+        # Adding stops can't shorten a trip, so only dropped stops matter.
+        if not set(snap.route).issubset(tuple(stop.to_list()) for stop in bus.route):
+            return True
+        moved = distance_meters(snap.position, (bus.location.latitude, bus.location.longitude))
+        return snap.cost - moved / MIN_SPEED_MPS < self.worst_cost
+
+
+class DispatchCache:
+    """
+    Keeps ranked candidate buses for the busiest pickup cells so a ride request
+    landing there only needs to verify a few buses instead of the whole fleet.
+    """
+    def __init__(self, osrm_url: str, logger: logging.Logger):
+        self.osrm_url = osrm_url
+        self.logger = logger
+        self.demand = DemandGrid()
+        self.rankings: Dict[Cell, CellRanking] = {}
+        # Bus changes seen while a refresh is awaiting OSRM, as (bus, removed).
+        self._changes: Optional[List[Tuple[BusState, bool]]] = None
+
+    def record_request(self, pickup_loc: Location):
+        self.demand.record(pickup_loc)
+
+    # --- Invalidation ---
+
+    def _on_change(self, bus: BusState, removed: bool = False):
+        if self._changes is not None:
+            self._changes.append((bus, removed))
+        for cell, ranking in list(self.rankings.items()):
+            if ranking.is_stale(bus, removed):
+                del self.rankings[cell]
+
+    def on_location(self, bus: BusState):
+        self._on_change(bus)
+
+    def on_route_change(self, bus: BusState):
+        self._on_change(bus)
+
+    def on_bus_removed(self, bus: BusState):
+        self._on_change(bus, removed=True)
+
+    # --- Precomputation ---
+
+    async def _rank_cell(self, cell: Cell, buses: List[BusState]) -> Optional[CellRanking]:
+        center = cell_center(cell)
+        # Snapshot before awaiting so it matches what the costs were computed from.
+        stops = [[bus.location] + bus.route + [center] for bus in buses]
+        snapshots = {bus.bus_id: BusSnapshot(bus) for bus in buses}
+        costs = await asyncio.gather(*[
+            get_trip_duration(bus_stops, self.osrm_url, self.logger) for bus_stops in stops
+        ])
+        for bus, cost in zip(buses, costs):
+            snapshots[bus.bus_id].cost = cost
+        ranked = sorted(
+            (cost, i) for i, cost in enumerate(costs) if cost != float('inf')
+        )[:CANDIDATES]
+        if not ranked:
+            return None
+        return CellRanking([buses[i] for _, i in ranked], snapshots)
+
+    async def refresh(self, buses: List[BusState]):
+        """
+        Recomputes rankings for hot cells that have none and drops cells that
+        cooled down.
+        """
+        hot = self.demand.hot_cells()
+        for cell in list(self.rankings):
+            if cell not in hot:
+                del self.rankings[cell]
+        missing = [cell for cell in hot if cell not in self.rankings]
+        buses = [bus for bus in buses if dispatchable(bus)]
+        if not missing or not buses:
+            return
+
+        self._changes = []
+        try:
+            for cell in missing:
+                seen = len(self._changes)
+                ranking = await self._rank_cell(cell, buses)
+                if ranking is None:
+                    continue
+                if any(ranking.is_stale(bus, removed) for bus, removed in self._changes[seen:]):
+                    continue
+                self.rankings[cell] = ranking
+        finally:
+            self._changes = None
+
+    async def run(self, busses: List[BusState], interval: float = 2.0):
+        while True:
+            try:
+                await self.refresh(busses)
+            except Exception as e:
+                self.logger.error(f"Dispatch precompute failed: {e}")
+            await asyncio.sleep(interval)
+
+    # --- Lookup ---
+
+    def candidates_for(self, pickup_loc: Location, buses: List[BusState]) -> Optional[List[BusState]]:
+        """
+        Returns the precomputed candidates for the pickup's cell, or None if the
+        cell is not hot or its ranking was invalidated.
+        """
+        ranking = self.rankings.get(cell_of(pickup_loc))
+        if ranking is None:
+            return None
+        candidates = [bus for bus in ranking.candidates if bus in buses and bus.location]
+        if not candidates:
+            return None
+        self.logger.debug(f"Using {len(candidates)} precomputed candidates for cell {cell_of(pickup_loc)}")
+        return candidates
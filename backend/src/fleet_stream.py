@@ -0,0 +1,277 @@
+import asyncio
+import json
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+# Compact encoding stores coordinates as integers in units of 1e-5 degrees (~1.1m).
+QUANTIZE_SCALE = 100000
+# Number of ticks kept around so a reconnecting client can resume from a seq.
+HISTORY_TICKS = 120
+# Ticks a client may fall behind before it gets a fresh snapshot instead.
+SUBSCRIBER_QUEUE_SIZE = 32
+
+BBox = Tuple[float, float, float, float]
+
+
+def quantize(value: float) -> int:
+    return int(round(value * QUANTIZE_SCALE))
+
+
+def parse_bbox(value: Optional[str]) -> Optional[BBox]:
+    """
+    Parses a "min_lat,min_lon,max_lat,max_lon" viewport string.
+    """
+    if not value:
+        return None
+    parts = [float(p) for p in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be min_lat,min_lon,max_lat,max_lon")
+    return tuple(parts)
+
+
+def parse_viewport(value) -> Optional[BBox]:
+    """
+    Parses the [min_lat, min_lon, max_lat, max_lon] list of a VIEWPORT message.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, list) or len(value) != 4:
+        raise ValueError("bbox must be [min_lat, min_lon, max_lat, max_lon]")
+    try:
+        return tuple(float(v) for v in value)
+    except TypeError:
+        raise ValueError("bbox values must be numbers")
+
+
+def in_bbox(bbox: Optional[BBox], lat: float, lon: float) -> bool:
+    if bbox is None:
+        return True
+    return bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]
+
+
+class FleetEntry:
+    """
+    Frozen view of one bus for a single tick. Encoded fragments are cached so
+    every subscriber of the tick shares the same strings.
+    """
+    def __init__(self, bus_id: int, lat: float, lon: float, route: List[List[float]], route_changed: bool):
+        self.bus_id = bus_id
+        self.lat = lat
+        self.lon = lon
+        self.route = route
+        self.route_changed = route_changed
+        self._fragments: Dict[Tuple[bool, bool], str] = {}
+
+    def fragment(self, compact: bool, with_route: bool = False) -> str:
+        with_route = with_route or self.route_changed
+        key = (compact, with_route)
+        if key not in self._fragments:
+            if compact:
+                data = [self.bus_id, quantize(self.lat), quantize(self.lon)]
+                if with_route:
+                    data.append([quantize(c) for stop in self.route for c in stop])
+                self._fragments[key] = json.dumps(data, separators=(",", ":"))
+            else:
+                data = {"id": self.bus_id, "location": [self.lat, self.lon]}
+                if with_route:
+                    data["route"] = self.route
+                self._fragments[key] = json.dumps(data)
+        return self._fragments[key]
+
+
+def render(msg_type: str, seq: int, fragments: List[str], removed: List[int], compact: bool) -> str:
+    """
+    Joins pre-encoded bus fragments into a message without re-encoding them.
+    """
+    if compact:
+        header = f'{{"type":"{msg_type}","seq":{seq},"q":{QUANTIZE_SCALE},'
+        removed_str = json.dumps(removed, separators=(",", ":"))
+        return header + '"buses":[' + ",".join(fragments) + '],"removed":' + removed_str + "}"
+    header = f'{{"type": "{msg_type}", "seq": {seq}, '
+    return header + '"buses": [' + ", ".join(fragments) + '], "removed": ' + json.dumps(removed) + "}"
+
+
+class FleetTick:
+    """
+    One batch of changes. Full (unfiltered) payloads are encoded once per
+    encoding and reused by every dashboard without a viewport.
+    """
+    def __init__(self, seq: int, entries: List[FleetEntry], removed: List[int]):
+        self.seq = seq
+        self.entries = entries
+        self.removed = removed
+        self._payloads: Dict[bool, str] = {}
+
+    def payload(self, compact: bool) -> str:
+        if compact not in self._payloads:
+            fragments = [entry.fragment(compact) for entry in self.entries]
+            self._payloads[compact] = render("DELTA", self.seq, fragments, self.removed, compact)
+        return self._payloads[compact]
+
+
+class FleetSubscriber:
+    def __init__(self, websocket: WebSocket, bbox: Optional[BBox], compact: bool):
+        self.websocket = websocket
+        self.bbox = bbox
+        self.compact = compact
+        # Bus ids this client currently displays; only tracked with a viewport.
+        self.visible: set = set()
+        # Highest seq already reflected on the client; older ticks are skipped.
+        self.last_seq = -1
+        # None in the queue means "drop what you have and resend a snapshot".
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def request_resync(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    def push(self, tick: FleetTick):
+        try:
+            self.queue.put_nowait(tick)
+        except asyncio.QueueFull:
+            self.request_resync()
+
+    def render_tick(self, tick: FleetTick) -> Optional[str]:
+        if self.bbox is None:
+            return tick.payload(self.compact)
+        fragments = []
+        removed = [bus_id for bus_id in tick.removed if bus_id in self.visible]
+        self.visible.difference_update(removed)
+        for entry in tick.entries:
+            if in_bbox(self.bbox, entry.lat, entry.lon):
+                # Buses entering the viewport need their route as well.
+                fragments.append(entry.fragment(self.compact, with_route=entry.bus_id not in self.visible))
+                self.visible.add(entry.bus_id)
+            elif entry.bus_id in self.visible:
+                self.visible.discard(entry.bus_id)
+                removed.append(entry.bus_id)
+        if not fragments and not removed:
+            return None
+        return render("DELTA", tick.seq, fragments, removed, self.compact)
+
+
+class FleetTracker:
+    """
+    Collects bus changes between ticks and fans them out to fleet dashboards
+    as an initial snapshot followed by batched deltas keyed by sequence number.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self.seq = 0
+        self.history: deque = deque(maxlen=HISTORY_TICKS)
+        self.subscribers: List[FleetSubscriber] = []
+        # bus_id -> (bus, route_changed) for buses changed since the last tick
+        self._dirty: Dict[int, tuple] = {}
+        self._removed: set = set()
+        self._snapshot_cache: Dict[bool, Tuple[int, str]] = {}
+
+    def mark_location(self, bus):
+        _, route_changed = self._dirty.get(bus.bus_id, (bus, False))
+        self._dirty[bus.bus_id] = (bus, route_changed)
+
+    def mark_route(self, bus):
+        self._dirty[bus.bus_id] = (bus, True)
+
+    def mark_removed(self, bus):
+        self._dirty.pop(bus.bus_id, None)
+        self._removed.add(bus.bus_id)
+
+    def flush(self) -> Optional[FleetTick]:
+        """
+        Turns pending changes into a tick and hands it to every subscriber.
+        Buses without a location yet stay pending until their first ping.
+        """
+        if not self._dirty and not self._removed:
+            return None
+        entries, pending = [], {}
+        for bus_id, (bus, route_changed) in self._dirty.items():
+            if bus.location is None:
+                pending[bus_id] = (bus, route_changed)
+                continue
+            entries.append(FleetEntry(
+                bus_id, bus.location.latitude, bus.location.longitude,
+                [stop.to_list() for stop in bus.route], route_changed,
+            ))
+        removed = sorted(self._removed)
+        self._dirty, self._removed = pending, set()
+        if not entries and not removed:
+            return None
+
+        self.seq += 1
+        tick = FleetTick(self.seq, entries, removed)
+        self.history.append(tick)
+        for subscriber in self.subscribers:
+            subscriber.push(tick)
+        return tick
+
+    def ticks_since(self, since: int) -> Optional[List[FleetTick]]:
+        """
+        Returns the retained ticks after `since`, or None if the client is too
+        far behind (or ahead) and needs a snapshot instead.
+        """
+        if since > self.seq:
+            return None
+        if since == self.seq:
+            return []
+        if not self.history or self.history[0].seq > since + 1:
+            return None
+        return [tick for tick in self.history if tick.seq > since]
+
+    def snapshot(self, busses, subscriber: FleetSubscriber) -> str:
+        subscriber.last_seq = self.seq
+        if subscriber.bbox is None:
+            cached = self._snapshot_cache.get(subscriber.compact)
+            if cached and cached[0] == self.seq:
+                return cached[1]
+        entries = [
+            FleetEntry(
+                bus.bus_id, bus.location.latitude, bus.location.longitude,
+                [stop.to_list() for stop in bus.route], True,
+            )
+            for bus in busses
+            if bus.location and in_bbox(subscriber.bbox, bus.location.latitude, bus.location.longitude)
+        ]
+        if subscriber.bbox is None:
+            payload = render("SNAPSHOT", self.seq, [e.fragment(subscriber.compact) for e in entries], [], subscriber.compact)
+            self._snapshot_cache[subscriber.compact] = (self.seq, payload)
+            return payload
+        subscriber.visible = {e.bus_id for e in entries}
+        return render("SNAPSHOT", self.seq, [e.fragment(subscriber.compact) for e in entries], [], subscriber.compact)
+
+    async def run(self, interval: float = 1.0):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Fleet tick failed: {e}")
+            await asyncio.sleep(interval)
+
+    async def stream(self, state, subscriber: FleetSubscriber, since: Optional[int]):
+        """
+        Sends the initial snapshot (or the missed deltas) and then every tick
+        queued for this subscriber until the socket closes.
+        """
+        ticks = self.ticks_since(since) if since is not None else None
+        if ticks is None or subscriber.bbox is not None:
+            # Viewport clients need a snapshot to know which buses they hold.
+            await subscriber.websocket.send_text(self.snapshot(state.busses, subscriber))
+        else:
+            subscriber.last_seq = since
+            for tick in ticks:
+                await subscriber.websocket.send_text(tick.payload(subscriber.compact))
+                subscriber.last_seq = tick.seq
+        while True:
+            tick = await subscriber.queue.get()
+            if tick is None:
+                await subscriber.websocket.send_text(self.snapshot(state.busses, subscriber))
+                continue
+            # Already covered by the snapshot or replay that was sent before it.
+            if tick.seq <= subscriber.last_seq:
+                continue
+            subscriber.last_seq = tick.seq
+            payload = subscriber.render_tick(tick)
+            if payload is not None:
+                await subscriber.websocket.send_text(payload)
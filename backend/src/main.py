@@ -1,13 +1,21 @@
-from typing import List
+from typing import List, Optional
 import json
 from states import AppState, BusState, Location, PickupLocation, DropoffLocation
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 import uvicorn
 from fastapi import WebSocket, WebSocketDisconnect
 import logging
 import asyncio
 import httpx
+import math
+import os
+import secrets
+import threading
 from algo.bus_logic import find_optimal_bus
+from algo.dispatch_cache import DispatchCache
+from fleet_stream import FleetTracker, FleetSubscriber, parse_bbox, parse_viewport
+from profiling import SamplingProfiler, StallDetector, parse_stall_threshold
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
@@ -17,6 +25,11 @@ logger = logging.getLogger(__name__)
 
 OSRM_SERVER_URL = "http://localhost:5000"
 
+# Admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get("LLLYFT_ADMIN_TOKEN")
+# Log the event loop stack when it is blocked longer than this; unset disables it
+STALL_THRESHOLD_MS = os.environ.get("LLLYFT_STALL_THRESHOLD_MS")
+
 
 origins = [
     "*"
@@ -31,6 +44,10 @@ app.add_middleware(
 )
 
 state = AppState()
+fleet = FleetTracker(logger)
+dispatch_cache = DispatchCache(OSRM_SERVER_URL, logger)
+profiler = None
+stall_detector = None
 
 @app.get("/")
 async def read_root():
@@ -42,6 +59,32 @@ async def read_root():
 async def start_ping_drivers():
     asyncio.create_task(ping_drivers())
 
+@app.on_event("startup")
+async def start_fleet_stream():
+    asyncio.create_task(fleet.run())
+
+@app.on_event("startup")
+async def start_dispatch_precompute():
+    asyncio.create_task(dispatch_cache.run(state.busses))
+
+@app.on_event("startup")
+async def start_profiling():
+    global profiler, stall_detector
+    # Startup runs on the event loop thread, which is the one worth sampling
+    profiler = SamplingProfiler(threading.get_ident())
+    threshold = parse_stall_threshold(STALL_THRESHOLD_MS, logger)
+    if threshold is not None:
+        stall_detector = StallDetector(threshold, logger)
+        stall_detector.start()
+        logger.info(f"Event loop stall detector enabled at {STALL_THRESHOLD_MS}ms")
+
+@app.on_event("shutdown")
+async def stop_profiling():
+    global stall_detector
+    if stall_detector is not None:
+        stall_detector.stop()
+        stall_detector = None
+
 async def ping_drivers():
     while True:
         for bus in state.busses:
@@ -82,14 +125,24 @@ async def websocket_driver(websocket: WebSocket):
             data_json = json.loads(data)
             data_type = data_json.get("type", None)
             if data_type == "LOC_PING":
+                first_fix = bus_state.location is None
                 bus_state.update_loc(data_json.get("location", None), data_json.get("loc_time", None))
+                if first_fix:
+                    fleet.mark_route(bus_state)
+                else:
+                    fleet.mark_location(bus_state)
+                dispatch_cache.on_location(bus_state)
                 await websocket.send_text(json.dumps({"msg": "Location ping received"}))
             elif data_type == "STOP_RECVD":
                 logger.info(f"Stop received: {data_json}")
                 bus_state.add_stop(data_json.get("location", None))
+                fleet.mark_route(bus_state)
+                dispatch_cache.on_route_change(bus_state)
                 await websocket.send_text(json.dumps({"msg": "Stop received"}))
             elif data_type == "STOP_REMOVED":
                 bus_state.remove_stop(data_json.get("location", None))
+                fleet.mark_route(bus_state)
+                dispatch_cache.on_route_change(bus_state)
                 await websocket.send_text(json.dumps({"msg": "Stop removed"}))
             elif data_type == "GET_NEXT":
                 next_stop = bus_state.get_next_stop()
@@ -102,8 +155,70 @@ async def websocket_driver(websocket: WebSocket):
             # await websocket.send_text(f"Received: {data}")
     except WebSocketDisconnect:
         logger.info(f"Driver disconnected")
+    finally:
+        state.remove_bus(bus_state)
+        fleet.mark_removed(bus_state)
+        dispatch_cache.on_bus_removed(bus_state)
+
+def fleet_sender_done(task: asyncio.Task, websocket: WebSocket):
+    # Without this a failed sender leaves the dashboard connected but silent
+    if task.cancelled() or task.exception() is None:
+        return
+    logger.error(f"Fleet stream failed: {task.exception()!r}")
+    asyncio.create_task(close_fleet_socket(websocket))
+
+async def close_fleet_socket(websocket: WebSocket):
+    try:
+        await websocket.close(code=1011)
+    except RuntimeError:
+        # Already closed by the client
         pass
 
+"""
+WebSocket endpoint for the operator fleet map
+Docs:
+    query params:
+        since: last seq the client applied; missed deltas are replayed if still retained
+        bbox: min_lat,min_lon,max_lat,max_lon viewport filter
+        compact: quantized array encoding (coordinates are ints, divide by "q")
+
+    server -> client:
+        SNAPSHOT: every bus (in the viewport) with its route, at seq
+        DELTA: buses that moved since the previous seq; "route" only when it changed,
+            "removed" lists bus ids to drop
+
+    client -> server:
+        VIEWPORT: other_params: bbox: [min_lat, min_lon, max_lat, max_lon] or null
+"""
+@app.websocket("/ws/fleet")
+async def websocket_fleet(websocket: WebSocket, since: Optional[int] = None, bbox: Optional[str] = None, compact: bool = False):
+    await websocket.accept()
+    try:
+        subscriber = FleetSubscriber(websocket, parse_bbox(bbox), compact)
+    except ValueError as e:
+        await websocket.close(code=1003, reason=str(e))
+        return
+    fleet.subscribers.append(subscriber)
+    sender = asyncio.create_task(fleet.stream(state, subscriber, since))
+    sender.add_done_callback(lambda task: fleet_sender_done(task, websocket))
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                data_json = json.loads(data)
+                if not isinstance(data_json, dict) or data_json.get("type") != "VIEWPORT":
+                    raise ValueError(f"Unknown message: {data}")
+                subscriber.bbox = parse_viewport(data_json.get("bbox", None))
+            except ValueError as e:
+                logger.warning(f"Ignoring fleet dashboard message: {e}")
+                continue
+            subscriber.request_resync()
+    except WebSocketDisconnect:
+        logger.info("Fleet dashboard disconnected")
+    finally:
+        sender.cancel()
+        fleet.subscribers.remove(subscriber)
+
 # deleted get best bus, replaced wiht find optimal bus
 
 async def get_bus(pickup_loc: Location, dropoff_loc: Location):
@@ -112,13 +227,25 @@ async def get_bus(pickup_loc: Location, dropoff_loc: Location):
         bus for bus in state.busses
         if bus.location and bus.route
     ]
-    my_bus, _ = await find_optimal_bus(
-        buses=buses,
-        pickup_loc=pickup_loc,
-        dropoff_loc=dropoff_loc,
-        osrm_url=OSRM_SERVER_URL, # Pass the config as an argument
-        logger=logger             # Pass the logger as an argument
-    )
+    # Requests in a hot cell only re-check the precomputed candidates
+    candidates = dispatch_cache.candidates_for(pickup_loc, buses)
+    my_bus = None
+    if candidates:
+        my_bus, _ = await find_optimal_bus(
+            buses=candidates,
+            pickup_loc=pickup_loc,
+            dropoff_loc=dropoff_loc,
+            osrm_url=OSRM_SERVER_URL,
+            logger=logger
+        )
+    if my_bus is None:
+        my_bus, _ = await find_optimal_bus(
+            buses=buses,
+            pickup_loc=pickup_loc,
+            dropoff_loc=dropoff_loc,
+            osrm_url=OSRM_SERVER_URL, # Pass the config as an argument
+            logger=logger             # Pass the logger as an argument
+        )
     # Tell the bus
     data = {
         "type": "RIDE_REQUEST",
@@ -158,12 +285,42 @@ async def request_ride(
     # FIXED: Create location objects from the coordinates provided in the request.
     pickup_location = PickupLocation(latitude=pickup_lat, longitude=pickup_lon)
     dropoff_location = DropoffLocation(latitude=dropoff_lat, longitude=dropoff_lon)
+    dispatch_cache.record_request(pickup_location)
 
     # FIXED: The call to get_bus now passes both locations.
     location = await get_bus(pickup_location, dropoff_location)
     print(location)
     return location
 
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str
+    if not token or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+"""
+Sampling profile of the event loop thread in collapsed-stack format
+(flamegraph.pl / speedscope). Requires the X-Admin-Token header.
+"""
+@app.get("/admin/profile")
+async def admin_profile(
+    seconds: float = 10.0,
+    interval: float = 0.005,
+    x_admin_token: Optional[str] = Header(None)
+):
+    check_admin(x_admin_token)
+    if not (math.isfinite(seconds) and math.isfinite(interval)):
+        raise HTTPException(status_code=422, detail="seconds and interval must be finite")
+    try:
+        folded = await profiler.profile(seconds, interval)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(
+        folded,
+        headers={"Content-Disposition": "attachment; filename=profile.folded"}
+    )
+
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
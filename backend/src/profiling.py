@@ -0,0 +1,149 @@
+import asyncio
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Optional
+
+# Upper bounds so a profile request can't run away under live load.
+MAX_PROFILE_SECONDS = 60.0
+MIN_SAMPLE_INTERVAL = 0.001
+# Lower bound for the stall threshold; the heartbeat runs every threshold / 4.
+MIN_STALL_THRESHOLD = 0.01
+
+
+def frame_to_folded(frame) -> str:
+    """
+    Formats a frame's stack root-first as "func (file:line);..." for collapsed-stack tools.
+    """
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop thread) from a background
+    thread. Nothing is hooked into the interpreter, so the profiled code only
+    pays for the GIL handoffs of the sampler.
+    """
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, interval: float) -> Counter:
+        """
+        Blocks the calling thread for `seconds` and returns stack -> sample count.
+        Raises RuntimeError if another profile is already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            seconds = max(min(seconds, MAX_PROFILE_SECONDS), 0.0)
+            # A sleep longer than the profile itself would hold the lock past the deadline.
+            interval = min(max(interval, MIN_SAMPLE_INTERVAL), max(seconds, MIN_SAMPLE_INTERVAL))
+            stacks: Counter = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    stacks[frame_to_folded(frame)] += 1
+                del frame
+                time.sleep(interval)
+            return stacks
+        finally:
+            self._lock.release()
+
+    async def profile(self, seconds: float, interval: float) -> str:
+        stacks = await asyncio.to_thread(self.sample, seconds, interval)
+        return to_folded(stacks)
+
+
+def to_folded(stacks: Counter) -> str:
+    """
+    Brendan Gregg's collapsed format, readable by flamegraph.pl and speedscope.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def parse_stall_threshold(value: Optional[str], logger) -> Optional[float]:
+    """
+    Parses a stall threshold in milliseconds into seconds. Returns None (detector
+    off) if unset, and logs a warning for anything invalid or below the minimum.
+    """
+    if not value:
+        return None
+    try:
+        threshold = float(value) / 1000
+    except ValueError:
+        threshold = float('nan')
+    if not math.isfinite(threshold) or threshold < MIN_STALL_THRESHOLD:
+        logger.warning(
+            f"Ignoring stall threshold {value!r}ms: must be a number >= "
+            f"{MIN_STALL_THRESHOLD * 1000:.0f}ms; stall detector disabled"
+        )
+        return None
+    return threshold
+
+
+class StallDetector:
+    """
+    Logs the event loop thread's stack whenever the loop fails to run a
+    heartbeat callback for longer than `threshold` seconds.
+    """
+    def __init__(self, threshold: float, logger):
+        if not threshold >= MIN_STALL_THRESHOLD:
+            raise ValueError(f"threshold must be at least {MIN_STALL_THRESHOLD}s")
+        self.threshold = threshold
+        self.logger = logger
+        self.stalls = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    async def _heartbeat(self):
+        while not self._stop.is_set():
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def _watch(self):
+        reported = False
+        while not self._stop.wait(self.threshold / 4):
+            blocked_for = time.monotonic() - self._last_beat
+            if blocked_for < self.threshold:
+                reported = False
+                continue
+            if reported:
+                continue
+            # Only report once per stall; the stack at detection time is the culprit.
+            reported = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no frame>"
+            del frame
+            self.logger.warning(f"Event loop blocked for {blocked_for * 1000:.0f}ms:\n{stack}")
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="stall-detector", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
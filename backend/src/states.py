@@ -25,6 +25,7 @@ class DropoffLocation(Location):
 
 class BusState:
     def __init__(self, websocket: WebSocket, logger):
+        self.bus_id = None
         self.websocket = websocket
         self.location = None
         self.loc_time = None
@@ -56,6 +57,13 @@ class AppState:
     def __init__(self):
         self.busses = []
         self.passenger_requests = []
+        self._next_bus_id = 0
 
     def add_bus(self, bus: BusState):
+        self._next_bus_id += 1
+        bus.bus_id = self._next_bus_id
         self.busses.append(bus)
+
+    def remove_bus(self, bus: BusState):
+        if bus in self.busses:
+            self.busses.remove(bus)
@@ -0,0 +1,198 @@
+# tests/test_dispatch_cache.py
+
+import asyncio
+import pytest
+import logging
+from unittest.mock import AsyncMock, MagicMock
+
+from algo import dispatch_cache as dc
+from algo.dispatch_cache import DemandGrid, DispatchCache, cell_of
+from states import BusState, Location
+
+# --- Fixtures and Mocks ---
+
+@pytest.fixture
+def logger():
+    """Provides a logger for tests."""
+    return logging.getLogger("test_logger")
+
+@pytest.fixture
+def pickup():
+    return Location(latitude=37.6871, longitude=-121.7081)
+
+def make_bus(bus_id, lat, lon, logger, route=True):
+    bus = BusState(websocket=MagicMock(), logger=logger)
+    bus.bus_id = bus_id
+    bus.location = Location(latitude=lat, longitude=lon)
+    if route:
+        bus.route = [Location(latitude=lat + 0.001, longitude=lon)]
+    return bus
+
+async def hot_cache(pickup, buses, logger):
+    cache = DispatchCache("http://mock-osrm-server:5000", logger)
+    cache.record_request(pickup)
+    cache.record_request(pickup)
+    await cache.refresh(buses)
+    return cache
+
+@pytest.fixture
+def fake_osrm(monkeypatch):
+    """
+    Replaces OSRM with a duration proportional to the first stop's latitude,
+    so buses further north are more expensive.
+    """
+    calls = []
+    async def get_trip_duration(stops, osrm_url, logger):
+        calls.append(stops)
+        await asyncio.sleep(0)
+        if len(stops) < 2:
+            return float('inf')
+        return stops[0].latitude * 1000 + len(stops)
+    monkeypatch.setattr(dc, "get_trip_duration", get_trip_duration)
+    return calls
+
+# --- Tests for DemandGrid ---
+
+def test_demand_grid_expires_old_requests(pickup):
+    """
+    Tests that only requests inside the rolling window count towards hot cells.
+    """
+    grid = DemandGrid(window=60)
+    grid.record(pickup, now=0)
+    grid.record(pickup, now=10)
+    assert grid.hot_cells(now=20) == [cell_of(pickup)]
+    assert grid.hot_cells(now=65) == []
+
+# --- Tests for DispatchCache ---
+
+@pytest.mark.asyncio
+async def test_refresh_ranks_by_trip_duration(fake_osrm, pickup, logger):
+    """
+    Tests that hot cells rank dispatchable buses by total trip duration,
+    the same objective find_optimal_bus uses, with one OSRM call per bus.
+    """
+    buses = [
+        make_bus(1, 37.70, -121.70, logger),
+        make_bus(2, 37.60, -121.70, logger),
+        make_bus(3, 37.50, -121.70, logger, route=False),
+    ]
+    cache = DispatchCache("http://mock-osrm-server:5000", logger)
+    cache.record_request(pickup)
+    await cache.refresh(buses)
+    assert cache.candidates_for(pickup, buses) is None
+
+    cache.record_request(pickup)
+    await cache.refresh(buses)
+    assert cache.candidates_for(pickup, buses) == [buses[1], buses[0]]
+    assert len(fake_osrm) == 2
+
+@pytest.mark.asyncio
+async def test_ranked_bus_changes_invalidate(fake_osrm, pickup, logger):
+    """
+    Tests that route changes and large moves of a ranked bus drop the ranking,
+    but small LOC_PING jitter keeps it.
+    """
+    bus = make_bus(1, 37.70, -121.70, logger)
+    cache = await hot_cache(pickup, [bus], logger)
+
+    bus.location = Location(latitude=37.7001, longitude=-121.70)
+    cache.on_location(bus)
+    assert cache.candidates_for(pickup, [bus]) == [bus]
+
+    bus.location = Location(latitude=37.72, longitude=-121.70)
+    cache.on_location(bus)
+    assert cache.candidates_for(pickup, [bus]) is None
+
+    await cache.refresh([bus])
+    bus.add_stop([37.8, -121.7])
+    cache.on_route_change(bus)
+    assert cache.candidates_for(pickup, [bus]) is None
+
+@pytest.mark.asyncio
+async def test_unranked_bus_changes(fake_osrm, pickup, logger):
+    """
+    Tests that an unranked bus only invalidates when it could beat the ranked
+    ones: a dropped stop or a move big enough to close the gap, not an added stop.
+    """
+    buses = [make_bus(i, 37.60 + i * 0.1, -121.70, logger) for i in range(1, 5)]
+    far = buses[3]
+    cache = await hot_cache(pickup, buses, logger)
+    assert far not in cache.candidates_for(pickup, buses)
+
+    far.add_stop([37.9, -121.7])
+    cache.on_route_change(far)
+    far.location = Location(latitude=far.location.latitude - 0.001, longitude=-121.70)
+    cache.on_location(far)
+    assert cache.candidates_for(pickup, buses) is not None
+
+    far.route = far.route[1:]
+    cache.on_route_change(far)
+    assert cache.candidates_for(pickup, buses) is None
+
+@pytest.mark.asyncio
+async def test_new_bus_invalidates_ranking(fake_osrm, pickup, logger):
+    """
+    Tests that a dispatchable bus that was not evaluated invalidates the ranking,
+    while one without a route does not.
+    """
+    bus = make_bus(1, 37.70, -121.70, logger)
+    cache = await hot_cache(pickup, [bus], logger)
+
+    cache.on_location(make_bus(2, 37.60, -121.70, logger, route=False))
+    assert cache.candidates_for(pickup, [bus]) == [bus]
+
+    cache.on_location(make_bus(3, 37.60, -121.70, logger))
+    assert cache.candidates_for(pickup, [bus]) is None
+
+@pytest.mark.asyncio
+async def test_change_during_refresh_discards_ranking(fake_osrm, pickup, logger):
+    """
+    Tests that a ranked bus changing while OSRM is being awaited keeps the
+    stale ranking from being stored.
+    """
+    bus = make_bus(1, 37.70, -121.70, logger)
+    cache = DispatchCache("http://mock-osrm-server:5000", logger)
+    cache.record_request(pickup)
+    cache.record_request(pickup)
+
+    async def move_bus():
+        bus.location = Location(latitude=37.80, longitude=-121.70)
+        cache.on_location(bus)
+
+    await asyncio.gather(cache.refresh([bus]), move_bus())
+    assert cache.candidates_for(pickup, [bus]) is None
+
+# --- Tests for the get_bus wiring ---
+
+@pytest.mark.asyncio
+async def test_request_ride_tries_candidates_then_full_fleet(monkeypatch, pickup, logger):
+    """
+    Tests that request_ride records demand, that a hot cell's candidates are
+    checked first, and that a None result falls back to the whole fleet.
+    """
+    import main
+    from algo.dispatch_cache import BusSnapshot, CellRanking
+    from states import AppState
+
+    state = AppState()
+    buses = [make_bus(0, 37.70, -121.70, logger), make_bus(0, 37.60, -121.70, logger)]
+    for bus in buses:
+        bus.websocket = AsyncMock()
+        state.add_bus(bus)
+    cache = DispatchCache("http://mock-osrm-server:5000", logger)
+    cache.rankings[cell_of(pickup)] = CellRanking([buses[0]], {bus.bus_id: BusSnapshot(bus) for bus in buses})
+    monkeypatch.setattr(main, "state", state)
+    monkeypatch.setattr(main, "dispatch_cache", cache)
+
+    calls = []
+    async def find_optimal_bus(buses, pickup_loc, dropoff_loc, osrm_url, logger):
+        calls.append(list(buses))
+        return (None, float('inf')) if len(calls) == 1 else (buses[1], 10.0)
+    monkeypatch.setattr(main, "find_optimal_bus", find_optimal_bus)
+
+    location = await main.request_ride(pickup.latitude, pickup.longitude, 37.8, -121.7)
+
+    assert cache.demand.counts[cell_of(pickup)] == 1
+    assert calls == [[buses[0]], buses]
+    assert location == buses[1].location
+    buses[1].websocket.send_text.assert_awaited_once()
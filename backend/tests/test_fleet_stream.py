@@ -0,0 +1,148 @@
+# tests/test_fleet_stream.py
+
+import asyncio
+import json
+import logging
+import pytest
+from unittest.mock import MagicMock
+
+from fleet_stream import FleetTracker, FleetSubscriber, parse_bbox, parse_viewport
+from states import AppState, BusState, Location
+
+# --- Fixtures ---
+
+@pytest.fixture
+def logger():
+    """Provides a logger for tests."""
+    return logging.getLogger("test_logger")
+
+@pytest.fixture
+def app_state(logger):
+    """Provides an AppState with one bus that has a location and a stop."""
+    state = AppState()
+    bus = BusState(websocket=MagicMock(), logger=logger)
+    state.add_bus(bus)
+    bus.location = Location(latitude=37.68, longitude=-121.70)
+    bus.route = [Location(latitude=37.70, longitude=-121.71)]
+    return state
+
+# --- Tests for FleetTracker ---
+
+def test_flush_batches_changes_into_one_delta(app_state, logger):
+    """
+    Tests that several changes to a bus between ticks become a single entry,
+    and that the route is only sent when it changed.
+    """
+    tracker = FleetTracker(logger)
+    bus = app_state.busses[0]
+    tracker.mark_route(bus)
+    tracker.mark_location(bus)
+
+    tick = tracker.flush()
+    data = json.loads(tick.payload(compact=False))
+    assert data["seq"] == 1
+    assert data["buses"] == [{"id": bus.bus_id, "location": [37.68, -121.70], "route": [[37.70, -121.71]]}]
+
+    tracker.mark_location(bus)
+    data = json.loads(tracker.flush().payload(compact=False))
+    assert data["buses"] == [{"id": bus.bus_id, "location": [37.68, -121.70]}]
+
+    assert tracker.flush() is None
+
+def test_payload_is_encoded_once_per_tick(app_state, logger):
+    """
+    Tests that every dashboard without a viewport shares the same payload string.
+    """
+    tracker = FleetTracker(logger)
+    tracker.mark_location(app_state.busses[0])
+    tick = tracker.flush()
+    assert tick.payload(compact=True) is tick.payload(compact=True)
+
+def test_compact_encoding_is_quantized(app_state, logger):
+    """
+    Tests that the compact encoding stores coordinates as scaled integers.
+    """
+    tracker = FleetTracker(logger)
+    tracker.mark_route(app_state.busses[0])
+    data = json.loads(tracker.flush().payload(compact=True))
+    assert data["q"] == 100000
+    assert data["buses"] == [[1, 3768000, -12170000, [3770000, -12171000]]]
+
+def test_ticks_since_falls_back_to_snapshot(app_state, logger):
+    """
+    Tests that resuming from a seq replays retained ticks, and that an unknown
+    seq asks for a snapshot instead.
+    """
+    tracker = FleetTracker(logger)
+    for _ in range(3):
+        tracker.mark_location(app_state.busses[0])
+        tracker.flush()
+
+    assert [tick.seq for tick in tracker.ticks_since(1)] == [2, 3]
+    assert tracker.ticks_since(3) == []
+    assert tracker.ticks_since(10) is None
+
+def test_viewport_subscriber_sees_bus_leave(app_state, logger):
+    """
+    Tests that a bus moving out of the viewport is reported as removed.
+    """
+    tracker = FleetTracker(logger)
+    bus = app_state.busses[0]
+    subscriber = FleetSubscriber(MagicMock(), parse_bbox("37,-122,38,-121"), compact=False)
+    snapshot = json.loads(tracker.snapshot(app_state.busses, subscriber))
+    assert [b["id"] for b in snapshot["buses"]] == [bus.bus_id]
+
+    bus.location = Location(latitude=40.0, longitude=-121.70)
+    tracker.mark_location(bus)
+    data = json.loads(subscriber.render_tick(tracker.flush()))
+    assert data["buses"] == []
+    assert data["removed"] == [bus.bus_id]
+
+def test_snapshot_cache_hit_skips_fleet(app_state, logger):
+    """
+    Tests that a cached snapshot is returned without walking the fleet again.
+    """
+    tracker = FleetTracker(logger)
+    subscriber = FleetSubscriber(MagicMock(), None, compact=True)
+    first = tracker.snapshot(app_state.busses, subscriber)
+    assert tracker.snapshot(None, subscriber) is first
+
+def test_parse_viewport_rejects_bad_bbox():
+    """
+    Tests that malformed VIEWPORT boxes raise ValueError.
+    """
+    assert parse_viewport([37, -122, 38, -121]) == (37.0, -122.0, 38.0, -121.0)
+    assert parse_viewport(None) is None
+    for bad in [[1, 2, 3], "1,2,3,4", ["a", 1, 2, 3], [None, 1, 2, 3]]:
+        with pytest.raises(ValueError):
+            parse_viewport(bad)
+
+@pytest.mark.asyncio
+async def test_stream_skips_ticks_covered_by_snapshot(app_state, logger):
+    """
+    Tests that a tick queued before a resync snapshot is not sent again after it.
+    """
+    tracker = FleetTracker(logger)
+    websocket = MagicMock()
+    sent = []
+    async def send_text(text):
+        sent.append(json.loads(text))
+        if len(sent) == 3:
+            raise ConnectionError("stop streaming")
+    websocket.send_text = send_text
+    subscriber = FleetSubscriber(websocket, None, compact=False)
+    tracker.subscribers.append(subscriber)
+
+    subscriber.request_resync()
+    tracker.mark_location(app_state.busses[0])
+    tracker.flush()
+    tracker.mark_location(app_state.busses[0])
+    tracker.flush()
+    sender = asyncio.create_task(tracker.stream(app_state, subscriber, since=None))
+    await asyncio.sleep(0)
+    tracker.mark_location(app_state.busses[0])
+    tracker.flush()
+    with pytest.raises(ConnectionError):
+        await asyncio.wait_for(sender, timeout=1)
+
+    assert [(msg["type"], msg["seq"]) for msg in sent] == [("SNAPSHOT", 2), ("SNAPSHOT", 2), ("DELTA", 3)]
@@ -0,0 +1,99 @@
+# tests/test_profiling.py
+
+import asyncio
+import logging
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+
+from profiling import SamplingProfiler, StallDetector, parse_stall_threshold, to_folded
+
+# --- Tests for SamplingProfiler ---
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_sampling_profiler_captures_target_thread():
+    """
+    Tests that samples come from the profiled thread and use the collapsed format.
+    """
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,))
+    worker.start()
+    try:
+        stacks = SamplingProfiler(worker.ident).sample(seconds=0.2, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert sum(stacks.values()) > 0
+    assert all("busy_loop" in stack for stack in stacks)
+    line = to_folded(stacks).splitlines()[0]
+    assert line.rsplit(" ", 1)[1].isdigit()
+
+def test_sampling_profiler_rejects_concurrent_profiles():
+    """
+    Tests that only one profile can run at a time.
+    """
+    profiler = SamplingProfiler(threading.get_ident())
+    worker = threading.Thread(target=profiler.sample, args=(0.2, 0.01))
+    worker.start()
+    time.sleep(0.05)
+    try:
+        with pytest.raises(RuntimeError):
+            profiler.sample(0.1, 0.01)
+    finally:
+        worker.join()
+
+def test_sampling_profiler_interval_is_bounded_by_duration():
+    """
+    Tests that a huge interval can't keep the profile running past its duration.
+    """
+    profiler = SamplingProfiler(threading.get_ident())
+    started = time.monotonic()
+    profiler.sample(seconds=0.1, interval=1e6)
+    assert time.monotonic() - started < 1
+    assert not profiler.running
+
+# --- Tests for StallDetector ---
+
+@pytest.mark.asyncio
+async def test_stall_detector_logs_blocking_call():
+    """
+    Tests that blocking the event loop logs one warning with the blocking stack.
+    """
+    logger = MagicMock(spec=logging.Logger)
+    detector = StallDetector(threshold=0.05, logger=logger)
+    detector.start()
+    heartbeat = detector._heartbeat_task
+    await asyncio.sleep(0.1)
+    try:
+        time.sleep(0.3)
+        await asyncio.sleep(0.1)
+    finally:
+        detector.stop()
+
+    await asyncio.sleep(0)
+    assert heartbeat.cancelled()
+    assert detector.stalls == 1
+    message = logger.warning.call_args[0][0]
+    assert "test_stall_detector_logs_blocking_call" in message
+
+def test_stall_threshold_rejects_bad_values():
+    """
+    Tests that invalid, zero, negative or too small thresholds leave the detector
+    off with a warning instead of failing startup or busy-looping.
+    """
+    logger = MagicMock(spec=logging.Logger)
+    assert parse_stall_threshold(None, logger) is None
+    assert parse_stall_threshold("250", logger) == 0.25
+    logger.warning.assert_not_called()
+
+    for bad in ["abc", "0", "-100", "5", "nan", "inf"]:
+        assert parse_stall_threshold(bad, logger) is None
+    assert logger.warning.call_count == 6
+
+    with pytest.raises(ValueError):
+        StallDetector(threshold=0.0, logger=logger)